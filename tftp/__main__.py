@@ -1,5 +1,5 @@
 import logging
-import socketserver
+import os
 import server
 import threading
 
@@ -12,6 +12,10 @@ PORT = 20069
 
 if __name__ == '__main__':
     logging.info("Starting TFTP server on {0}:{1}".format(HOST, PORT))
-    srv = socketserver.ThreadingUDPServer((HOST, PORT), server.Handler)
-    thread = threading.Thread(target=srv.serve_forever)
-    thread.start()
+    if os.environ.get('TFTP_ASYNCIO'):
+        import aioserver
+        aioserver.serve(HOST, PORT)
+    else:
+        srv = server.Server((HOST, PORT), server.Handler)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
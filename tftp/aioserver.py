@@ -0,0 +1,321 @@
+import abc
+import asyncio
+import functools
+import logging
+
+import server
+import storage
+
+log = logging.getLogger(__name__)
+
+class Transfer(asyncio.DatagramProtocol, metaclass=abc.ABCMeta):
+    """Base class for a single transfer served from its own ephemeral
+    endpoint (the server TID). Retransmits are driven by a loop timer
+    rather than a blocking recv, so one thread serves every transfer.
+    """
+    def __init__(self, address, filename, mode, done):
+        self.address = address
+        self.filename = filename
+        self.mode = mode
+        self.done = done
+        self.transport = None
+        self.timer = None
+        self.sendCount = 0
+        self.rto = server.RetransmitTimer()
+        self.sentAt = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        server.setSocketBuffers(sock)
+        server.setBusyPoll(sock)
+        self.start()
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.done(self.address)
+
+    def error_received(self, exc):
+        log.info(
+            "Client [%s:%s]: Socket error: %s",
+            *self.address, exc)
+        # The endpoint is connected, so a client that went away shows up
+        # as ConnectionRefusedError (ICMP port unreachable)
+        if isinstance(exc, ConnectionRefusedError):
+            self.transport.close()
+
+    @abc.abstractmethod
+    def start(self):
+        """Begins the transfer once the endpoint is connected"""
+
+    @abc.abstractmethod
+    def send(self):
+        """(Re)sends the packet(s) the client has not acknowledged yet"""
+
+    def timeout(self):
+        """Returns the seconds to wait before retransmitting"""
+        return self.rto.rto
+
+    def transmit(self):
+        """Sends the pending packet(s) and arms the retransmit timer.
+        Gives up once MAX_PACKET_SEND_ATTEMPTS is reached.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.sendCount >= server.MAX_PACKET_SEND_ATTEMPTS:
+            self.sendError(
+                server.ErrorCode.ACCESS_VIOLATION,
+                "Maximum number of packet send attempts reached: [{}]"\
+                .format(self.sendCount))
+            return
+        self.send()
+        self.sendCount += 1
+        loop = asyncio.get_running_loop()
+        self.sentAt = loop.time()
+        self.timer = loop.call_later(self.timeout(), self.retransmit)
+
+    def retransmit(self):
+        self.rto.backoff()
+        self.transmit()
+
+    def acknowledged(self):
+        """Called when the client acknowledges the pending packet(s).
+        Only packets sent once give an unambiguous RTT sample (Karn).
+        """
+        if self.sendCount == 1:
+            self.rto.sample(asyncio.get_running_loop().time() - self.sentAt)
+        self.sendCount = 0
+
+    def sendError(self, code, msg):
+        self.transport.sendto(server.getERROR(code, msg))
+        server.logClientError(self.address, msg)
+        self.transport.close()
+
+class ReadTransfer(Transfer):
+    """Serves an RRQ: sends an optional OACK, then windows of DATA packets"""
+    def __init__(self, address, filename, mode, options, done):
+        super().__init__(address, filename, mode, done)
+        self.options = options
+        self.file = None
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self.file is not None:
+            self.file.release()
+
+    def start(self):
+        log.info(
+            "Client [%s:%s] requested to read file [%s] using transfer mode [%s]",
+            *self.address, self.filename, self.mode)
+        store = storage.Storage()
+        try:
+            if self.mode == server.Modes['NETASCII']:
+                self.file = store.viewEncoded(
+                    self.filename, server.encodeNetascii)
+            else:
+                self.file = store.view(self.filename)
+        except (storage.ErrorFileNotFound, storage.ErrorEmptyPath) as ex:
+            self.sendError(server.ErrorCode.FILE_NOT_FOUND, str(ex))
+            return
+
+        self.accepted = server.negotiateOptions(self.options, len(self.file))
+        self.blksize = self.accepted.get('blksize', server.DATA_BLOCK_SIZE)
+        self.windowsize = self.accepted.get('windowsize', 1)
+        self.oack = server.packOACK(self.accepted) if self.accepted else None
+        # An exact multiple of blksize ends with an empty block
+        self.lastBlock = len(self.file) // self.blksize + 1
+        # Every DATA packet of the transfer is built in this one buffer
+        self.buf = bytearray(4 + self.blksize)
+        self.ackBlock = 0
+        self.sentBlock = 0
+        self.transmit()
+
+    def send(self):
+        if self.oack is not None:
+            self.transport.sendto(self.oack)
+            return
+        self.sentBlock = min(self.ackBlock + self.windowsize, self.lastBlock)
+        for block in range(self.ackBlock + 1, self.sentBlock + 1):
+            self.transport.sendto(server.packDATAInto(
+                self.buf,
+                self.file[(block - 1) * self.blksize:block * self.blksize],
+                block & 0xFFFF))
+
+    def datagram_received(self, packet, address):
+        try:
+            opcode, block = server.unpackACK(packet)
+        except server.ErrorIllegalOperation as ex:
+            if server.unpackOpcode(packet) == server.Opcode.ERROR:
+                log.info(
+                    "Client [%s:%s] aborted transfer of file [%s]",
+                    *self.address, self.filename)
+                self.transport.close()
+            else:
+                self.sendError(server.ErrorCode.ILLEGAL_OPERATION, str(ex))
+            return
+        except (server.ErrorUnknownOpcode, server.ErrorMalformedPacket) as ex:
+            self.sendError(server.ErrorCode.ILLEGAL_OPERATION, str(ex))
+            return
+
+        if self.oack is not None:
+            # The OACK is acknowledged by ACK[0]
+            if block == 0:
+                self.oack = None
+                self.acknowledged()
+                self.transmit()
+            return
+
+        # Ignore ACKs outside of the window in flight
+        advance = (block - self.ackBlock) & 0xFFFF
+        if not 0 < advance <= self.sentBlock - self.ackBlock:
+            return
+        self.ackBlock += advance
+        self.acknowledged()
+        if self.ackBlock == self.lastBlock:
+            log.debug(
+                "Client [%s:%s]: Finished sending file %s",
+                *self.address, self.filename)
+            self.transport.close()
+            return
+        self.transmit()
+
+class WriteTransfer(Transfer):
+    """Serves a WRQ: acknowledges each DATA packet until a short one"""
+    def start(self):
+        log.info(
+            "Client [%s:%s] requested to put file [%s] using transfer mode [%s]",
+            *self.address, self.filename, self.mode)
+        if self.filename in storage.Storage().store:
+            self.sendError(
+                server.ErrorCode.FILE_EXISTS,
+                "File '{}' already exists".format(self.filename))
+            return
+
+        self.file = bytearray()
+        self.dataBlock = 0
+        self.transmit()
+
+    def timeout(self):
+        """Writes wait a fixed SOCKET_TIMEOUT, as handleWRQ does"""
+        return server.SOCKET_TIMEOUT
+
+    def send(self):
+        self.transport.sendto(server.packACK(self.dataBlock & 0xFFFF))
+
+    def datagram_received(self, packet, address):
+        try:
+            opcode, block, chunk = server.unpackDATA(packet)
+        except (server.ErrorMalformedPacket,
+                server.ErrorIllegalOperation,
+                server.ErrorUnknownOpcode) as ex:
+            self.sendError(server.ErrorCode.ILLEGAL_OPERATION, str(ex))
+            return
+
+        # Duplicates are answered by the retransmit timer
+        if block != (self.dataBlock + 1) & 0xFFFF:
+            return
+        self.dataBlock += 1
+        self.file.extend(chunk)
+        self.acknowledged()
+        if len(chunk) >= server.DATA_BLOCK_SIZE:
+            self.transmit()
+            return
+
+        # File transfer is terminated by acknowledging the last data packet
+        log.debug(
+            "Client [%s:%s]: Terminating transfer. Writing [%s] bytes of '%s'",
+            *self.address, len(self.file), self.filename)
+        file = self.file
+        if self.mode == server.Modes['NETASCII']:
+            file = server.decodeNetascii(file)
+        try:
+            storage.Storage().put(self.filename, file)
+        except storage.ErrorFileExists as ex:
+            self.sendError(server.ErrorCode.FILE_EXISTS, str(ex))
+            return
+        self.send()
+        self.transport.close()
+
+class ListenProtocol(asyncio.DatagramProtocol):
+    """Receives RRQ/WRQ packets on the listening endpoint and starts a
+    Transfer on a new ephemeral endpoint for each of them.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.transport = None
+        self.transfers = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        server.setSocketBuffers(transport.get_extra_info('socket'))
+
+    def datagram_received(self, packet, address):
+        log.debug("Receiving packet from client: %s", packet)
+        try:
+            opcode, filename, mode, options = server.unpackRWRQ(packet)
+        except server.ErrorUnknownMode as ex:
+            self.sendError(address, server.ErrorCode.ACCESS_VIOLATION, ex)
+            return
+        except storage.ErrorEmptyPath as ex:
+            self.sendError(address, server.ErrorCode.FILE_NOT_FOUND, ex)
+            return
+        except (server.ErrorIllegalOperation,
+                server.ErrorUnknownOpcode,
+                server.ErrorMalformedPacket) as ex:
+            self.sendError(address, server.ErrorCode.ILLEGAL_OPERATION, ex)
+            return
+
+        # A retransmitted request must not start a second transfer
+        if address in self.transfers:
+            return
+
+        if opcode == server.Opcode.RRQ:
+            transfer = ReadTransfer(
+                address, filename, mode, options, self.transfers.pop)
+        else:
+            transfer = WriteTransfer(
+                address, filename, mode, self.transfers.pop)
+        self.transfers[address] = transfer
+
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(loop.create_datagram_endpoint(
+            lambda: transfer,
+            local_addr=(self.host, 0),
+            remote_addr=address))
+        task.add_done_callback(functools.partial(self.endpointDone, address))
+
+    def endpointDone(self, address, task):
+        """Forgets the transfer for address if its endpoint could not be
+        created, so later requests from the client are not dropped as
+        retransmits.
+        """
+        if task.cancelled():
+            self.transfers.pop(address, None)
+        elif task.exception() is not None:
+            self.transfers.pop(address, None)
+            log.error(
+                "Client [%s:%s]: Unable to start transfer: %s",
+                *address, task.exception())
+
+    def sendError(self, address, code, ex):
+        self.transport.sendto(server.getERROR(code, str(ex)), address)
+        server.logClientError(address, ex)
+
+async def listen(host, port):
+    """Binds the listening endpoint and returns (transport, protocol)"""
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(
+        lambda: ListenProtocol(host),
+        local_addr=(host, port))
+
+def serve(host, port):
+    """Runs the asyncio TFTP server until interrupted"""
+    async def main():
+        transport, protocol = await listen(host, port)
+        try:
+            await asyncio.Future()
+        finally:
+            transport.close()
+
+    asyncio.run(main())
@@ -1,10 +1,42 @@
+import concurrent.futures
+import enum
+import functools
 import logging
+import os
+import platform
+import selectors
 import socketserver
 import socket
 import storage
+import struct
+import sys
+import time
 
 DATA_BLOCK_SIZE = 512
 MAX_PACKET_SEND_ATTEMPTS = 10
+# Seconds to wait for the client before retransmitting the last packet(s).
+# Reads adapt the wait to the measured round trip time within
+# [MIN_RTO, MAX_RTO]; writes always wait SOCKET_TIMEOUT.
+SOCKET_TIMEOUT = 1.0
+MIN_RTO = 0.2
+MAX_RTO = SOCKET_TIMEOUT
+# RFC 2348 blksize and RFC 7440 windowsize bounds accepted during negotiation
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464
+MAX_WINDOWSIZE = 64
+# Requested kernel buffer sizes for every server socket. Linux silently clamps
+# these to net.core.rmem_max / net.core.wmem_max.
+SOCKET_RCVBUF = int(os.environ.get('TFTP_RCVBUF', 4 * 1024 * 1024))
+SOCKET_SNDBUF = int(os.environ.get('TFTP_SNDBUF', 4 * 1024 * 1024))
+# Microseconds a transfer socket busy polls the device queue for ACK/DATA
+# packets instead of sleeping. 0 disables busy polling.
+BUSY_POLL_USEC = int(os.environ.get('TFTP_BUSY_POLL', 0))
+# Number of pooled threads serving requests; further requests are queued.
+MAX_WORKERS = int(os.environ.get('TFTP_WORKERS', 64))
+# Number of distinct ERROR packets kept by getERROR()
+ERROR_CACHE_SIZE = 128
+
+log = logging.getLogger(__name__)
 
 class ErrorUnknownOpcode(Exception):
     pass
@@ -21,35 +53,29 @@ class ErrorUnknownMode(Exception):
 class ErrorMalformedPacket(Exception):
     pass
 
-Opcodes = {
-    'RRQ': 0x01,
-    'WRQ': 0x02,
-    'DATA': 0x03,
-    'ACK': 0x04,
-    'ERROR': 0x05,
-    0x01: 'RRQ',
-    0x02: 'WRQ',
-    0x03: 'DATA',
-    0x04: 'ACK',
-    0x05: 'ERROR'}
-
-Errors = {
-    'NOT_DEFINED': 0x00,
-    'FILE_NOT_FOUND': 0x01,
-    'ACCESS_VIOLATION': 0x02,
-    'ALLOCATION_EXCEEDED': 0x03,
-    'ILLEGAL_OPERATION': 0x04,
-    'UNKNOWN_TRANSFER_ID': 0x05,
-    'FILE_EXISTS': 0x06,
-    'NO_SUCH_USER': 0x07,
-    0x00: 'NOT_DEFINED',
-    0x01: 'FILE_NOT_FOUND',
-    0x02: 'ACCESS_VIOLATION',
-    0x03: 'ALLOCATION_EXCEEDED',
-    0x04: 'ILLEGAL_OPERATION',
-    0x05: 'UNKNOWN_TRANSFER_ID',
-    0x06: 'FILE_EXISTS',
-    0x07: 'NO_SUCH_USER'}
+class ErrorTransferAborted(Exception):
+    pass
+
+class ErrorTransferTimeout(Exception):
+    pass
+
+class Opcode(enum.IntEnum):
+    RRQ = 0x01
+    WRQ = 0x02
+    DATA = 0x03
+    ACK = 0x04
+    ERROR = 0x05
+    OACK = 0x06
+
+class ErrorCode(enum.IntEnum):
+    NOT_DEFINED = 0x00
+    FILE_NOT_FOUND = 0x01
+    ACCESS_VIOLATION = 0x02
+    ALLOCATION_EXCEEDED = 0x03
+    ILLEGAL_OPERATION = 0x04
+    UNKNOWN_TRANSFER_ID = 0x05
+    FILE_EXISTS = 0x06
+    NO_SUCH_USER = 0x07
 
 Modes = {
     'OCTET': 'octet',
@@ -57,12 +83,40 @@ Modes = {
     'octet': 'OCTET',
     'netascii': 'NETASCII'}
 
+# Precompiled layouts of the fixed-size packet fields. The 4 byte header is
+# the Opcode followed by a block number (DATA/ACK) or error code (ERROR).
+_OPCODE = struct.Struct('!H')
+_HEADER = struct.Struct('!HH')
+# Plain int aliases keep enum attribute lookups and comparisons off the
+# per-packet path
+_RRQ = int(Opcode.RRQ)
+_WRQ = int(Opcode.WRQ)
+_DATA = int(Opcode.DATA)
+_ACK = int(Opcode.ACK)
+_ERROR = int(Opcode.ERROR)
+_OACK = int(Opcode.OACK)
+_NOT_DEFINED = int(ErrorCode.NOT_DEFINED)
+_NO_SUCH_USER = int(ErrorCode.NO_SUCH_USER)
+_OACK_OPCODE = _OPCODE.pack(Opcode.OACK)
+# Windows sockets lack scatter/gather sendmsg()
+_SENDMSG = hasattr(socket.socket, 'sendmsg')
+# Python does not export SO_BUSY_POLL. 46 is the asm-generic Linux value;
+# parisc and sparc number their socket options differently.
+_SO_BUSY_POLL = getattr(
+    socket,
+    'SO_BUSY_POLL',
+    46 if sys.platform.startswith('linux')
+        and not platform.machine().startswith(('parisc', 'sparc'))
+        else None)
+
 def unpackOpcode(packet):
     """Returns an integer corresponding to Opcode encoded in packet.
     Raises ErrorUnknownOpcode if Opcode is out of bounds.
     """
-    c = int.from_bytes(packet[:2], byteorder='big')
-    if c not in Opcodes:
+    if len(packet) < 2:
+        raise ErrorUnknownOpcode("Packet too short to hold an Opcode")
+    c, = _OPCODE.unpack_from(packet)
+    if not _RRQ <= c <= _OACK:
         raise ErrorUnknownOpcode("Unknown Opcode '{}'".format(c))
     return c
 
@@ -70,66 +124,121 @@ def packERROR(code, msg):
     """Returns a byte-ordered TFTP Error packet based on code and msg.
     Raises ErrorUnknownErrorCode when code is out of bounds.
     """
-    if code not in Errors:
+    if not _NOT_DEFINED <= code <= _NO_SUCH_USER:
         raise ErrorUnknownErrorCode("Unknown error code '{}'".format(code))
 
-    b = bytearray()
-    b.extend(Opcodes['ERROR'].to_bytes(2, 'big'))
-    b.extend(code.to_bytes(2, 'big'))
-    b.extend(bytes(msg, 'utf-8'))
-    b.append(0)
-    return b
+    return _HEADER.pack(_ERROR, code) + msg.encode('utf-8') + b'\x00'
+
+@functools.lru_cache(maxsize=ERROR_CACHE_SIZE)
+def getERROR(code, msg):
+    """Returns packERROR(code, msg), reusing the packet built for a
+    recently seen (code, msg) pair. A flood of the same bad request is
+    answered without building a new packet each time.
+    """
+    return packERROR(code, msg)
 
 def packDATA(data, blockNum):
     """Returns byte-formatted DATA packet"""
-    b = bytearray()
-    b.extend(Opcodes['DATA'].to_bytes(2, 'big'))
-    b.extend(blockNum.to_bytes(2, 'big'))
+    b = bytearray(_HEADER.pack(_DATA, blockNum))
     if data:
         b.extend(data)
     return b
 
+def packDATAInto(buf, data, blockNum):
+    """Writes a DATA packet into the preallocated bytearray buf, which must
+    hold at least 4 + len(data) bytes, and returns a memoryview of the
+    packet. Reusing buf for a whole transfer avoids allocating every packet.
+    """
+    n = len(data)
+    _HEADER.pack_into(buf, 0, _DATA, blockNum)
+    buf[4:4 + n] = data
+    return memoryview(buf)[:4 + n]
+
+def sendDATA(sock, buf, data, blockNum):
+    """Sends a DATA packet carrying data on the connected socket sock, using
+    the preallocated bytearray buf as in packDATAInto. Where sendmsg() is
+    available the header and data are passed to the kernel as separate
+    buffers (scatter/gather), so data is not copied into buf first.
+    """
+    if _SENDMSG:
+        _HEADER.pack_into(buf, 0, _DATA, blockNum)
+        sock.sendmsg((memoryview(buf)[:4], data))
+    else:
+        sock.send(packDATAInto(buf, data, blockNum))
+
+def recvQueued(sock, bufsize):
+    """Returns a list of the packets already queued on the non-blocking
+    socket sock, without waiting for more.
+    Raises BlockingIOError if no packet is queued.
+    """
+    packets = [sock.recv(bufsize)]
+    try:
+        while True:
+            packets.append(sock.recv(bufsize))
+    except BlockingIOError:
+        return packets
+    except ConnectionRefusedError:
+        # Keep the packets already received. The client is gone, so the
+        # next send draws another ICMP error that the next recv reports.
+        return packets
+
 def unpackDATA(packet):
     """Returns tuple of (Opcode, BlockNum, Data)
     Raises ErrorIllegalOperation when passed a non-DATA packet
     Raises ErrorMalformedPacket if packet is missized
     """
+    # The header is parsed once for a well formed packet; anything else
+    # goes through unpackOpcode() to raise the precise error
+    if len(packet) >= 4:
+        opcode, blockNum = _HEADER.unpack_from(packet)
+        if opcode == _DATA:
+            return (opcode, blockNum, packet[4:])
+
     opcode = unpackOpcode(packet)
-    if opcode != Opcodes['DATA']:
+    if opcode != _DATA:
         raise ErrorIllegalOperation(
             "Expected DATA packet, but got '{0}'"\
-            .format(Opcodes[opcode]))
-
-    if len(packet) < 4:
-        raise ErrorMalformedPacket("Data packet missing block number")
-
-    blockNum = int.from_bytes(packet[2:4], 'big')
-    data = packet[4:]
-    return (opcode, blockNum, data)
+            .format(Opcode(opcode).name))
+    raise ErrorMalformedPacket("Data packet missing block number")
 
 def unpackRWRQ(packet):
-    """Returns a tuple of (Opcode, Filename, Mode)
+    """Returns a tuple of (Opcode, Filename, Mode, Options)
+    Options is a dict of lowercased RFC 2347 option names to their string
+    values, empty when the request carries no options.
     Raises ErrorIllegalOperation when passed a non-RRQ/WRQ packet
-    Raises ErrorMalformedPacket when missing file/mode termination byte
+    Raises ErrorMalformedPacket when missing file/mode/option termination byte
+    or when a field is not valid UTF-8
     Raises ErrorEmptyPath if filename is empty
     """
     opcode = unpackOpcode(packet)
-    if opcode not in (Opcodes['RRQ'], Opcodes['WRQ']):
+    if opcode not in (_RRQ, _WRQ):
         raise ErrorIllegalOperation(
             "Expected RRQ or WRQ but got '{0}'"\
-            .format(Opcodes[opcode]))
+            .format(Opcode(opcode).name))
 
-    start = 2
-    end = packet.find(0, start)
-    if end < start:
+    # Every field is null terminated, so a well formed request always
+    # ends with an empty part
+    parts = packet[2:].split(b'\x00')
+    if len(parts) < 2:
         raise ErrorMalformedPacket("Couldn't find filename termination byte")
-    filename = packet[start:end].decode('utf-8')
-
-    start = end + 1
-    end = packet.find(0, start)
-    if end < start:
+    if len(parts) < 3:
         raise ErrorMalformedPacket("Couldn't find mode termination byte")
-    mode = packet[start:end].decode('utf-8')
+    if parts[-1]:
+        raise ErrorMalformedPacket("Couldn't find option termination byte")
+
+    fields = parts[2:-1]
+    if len(fields) % 2:
+        raise ErrorMalformedPacket(
+            "Couldn't find value termination byte for option '{}'"\
+            .format(fields[-1].decode('utf-8', 'replace')))
+    try:
+        filename = parts[0].decode('utf-8')
+        mode = parts[1].decode('utf-8')
+        options = {
+            name.decode('utf-8').lower(): value.decode('utf-8')
+            for name, value in zip(fields[::2], fields[1::2])}
+    except UnicodeDecodeError as ex:
+        raise ErrorMalformedPacket("Request is not valid UTF-8: {}".format(ex))
 
     if not filename:
         raise storage.ErrorEmptyPath("Filename cannot be empty")
@@ -137,36 +246,112 @@ def unpackRWRQ(packet):
         raise ErrorUnknownMode(
             "Mode '{}' not recognized"\
             .format(mode))
-    return (opcode, filename, mode.lower())
+    return (opcode, filename, mode.lower(), options)
+
+def negotiateOptions(options, fileSize):
+    """Returns a dict of the options the server accepts for a read request,
+    mapping option name to integer value. Unknown options and malformed
+    values are left out, as permitted by RFC 2347. Values larger than the
+    server supports are lowered to MAX_BLKSIZE and MAX_WINDOWSIZE.
+    """
+    accepted = {}
+    for name, low, high in (
+            ('blksize', MIN_BLKSIZE, MAX_BLKSIZE),
+            ('windowsize', 1, MAX_WINDOWSIZE)):
+        try:
+            value = int(options[name])
+        except (KeyError, ValueError):
+            continue
+        if value >= low:
+            accepted[name] = min(value, high)
+
+    if 'tsize' in options:
+        accepted['tsize'] = fileSize
+    return accepted
+
+def packOACK(options):
+    """Returns a byte-formatted OACK packet acknowledging options"""
+    b = bytearray(_OACK_OPCODE)
+    for name, value in options.items():
+        b.extend(bytes(name, 'utf-8'))
+        b.append(0)
+        b.extend(bytes(str(value), 'utf-8'))
+        b.append(0)
+    return b
 
 def unpackACK(packet):
     """Returns a tuple of (Opcode, BlockNum)
     Raises ErrorIllegalOperation if passed a non-ACK packet
+    Raises ErrorMalformedPacket if packet is missized
     """
+    # As in unpackDATA(), only a malformed packet is parsed twice
+    if len(packet) >= 4:
+        opcode, blockNum = _HEADER.unpack_from(packet)
+        if opcode == _ACK:
+            return (opcode, blockNum)
+
     opcode = unpackOpcode(packet)
-    if opcode != Opcodes['ACK']:
+    if opcode != _ACK:
         raise ErrorIllegalOperation(
             "Expected ACK packet, but got '{0}'"\
-            .format(Opcodes[opcode]))
-
-    blockNum = int.from_bytes(packet[2:4], 'big')
-    return (opcode, blockNum)
+            .format(Opcode(opcode).name))
+    raise ErrorMalformedPacket("ACK packet missing block number")
 
 def packACK(blockNum):
     """Returns a byte-formatted ACK packet"""
-    b = bytearray()
-    b.extend(Opcodes['ACK'].to_bytes(2, 'big'))
-    b.extend(blockNum.to_bytes(2, 'big'))
-    return b
+    return _HEADER.pack(_ACK, blockNum)
+
+def setSocketBuffers(sock):
+    """Enlarges the kernel receive and send buffers of sock to
+    SOCKET_RCVBUF and SOCKET_SNDBUF so bursts of datagrams are queued
+    instead of dropped.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+
+class RetransmitTimer(object):
+    """Retransmission timeout estimator following RFC 6298
+    (Jacobson/Karels). Each RTT sample updates the smoothed RTT and its
+    variance, giving rto = srtt + 4 * rttvar clamped to [MIN_RTO, MAX_RTO].
+    Every timeout doubles rto up to MAX_RTO.
+    """
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = MAX_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+def setBusyPoll(sock):
+    """Enables SO_BUSY_POLL for BUSY_POLL_USEC on sock where the platform
+    supports it. Raising the value above net.core.busy_read needs
+    CAP_NET_ADMIN, so failures are logged and otherwise ignored.
+    """
+    if not BUSY_POLL_USEC or _SO_BUSY_POLL is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_BUSY_POLL, BUSY_POLL_USEC)
+    except OSError as ex:
+        log.debug("Unable to enable busy polling: %s", ex)
 
 def logClientError(address, error):
     """logClientError takes an address tuple of (address, port)
     and an error message, formats a logline when an error message
     is handled and delivered to the client.
     """
-    logging.info(
-        "Sent error to Client [{0}:{1}]: {2}"\
-        .format(*address, error))
+    log.info(
+        "Sent error to Client [%s:%s]: %s",
+        *address, error)
 
 def encodeNetascii(data):
     """TFTP adopts the modifications to US-ASCII from RFC-764 Telnet
@@ -227,141 +412,203 @@ def decodeNetascii(data):
             out.append(b)
     return out
 
-def handleRRQ(address, sock, filename, mode):
-    """Acknowledges RRQ packet by sending DATA packets.
-    Each DATA packet is 4 header bytes + 512 bytes long, except for the last
-    packet which is 4 header bytes + (0 <= data bytes < 512).
-    Each transmitted DATA packet expects to receive a corresponding ACK packet.
+def handleRRQ(address, sock, filename, mode, options=None):
+    """Acknowledges RRQ packet by sending the file as DATA packets.
+    The file is served from a read-only view of storage; the view is
+    released when the transfer ends, however it ends.
     """
-    logging.info(
-        "Client [{0}:{1}] requested to read file [{2}] using transfer mode [{3}]"\
-        .format(*address, filename, mode))
+    log.info(
+        "Client [%s:%s] requested to read file [%s] using transfer mode [%s]",
+        *address, filename, mode)
     store = storage.Storage()
 
     try:
-        file = store.get(filename)
+        if mode == Modes['NETASCII']:
+            file = store.viewEncoded(filename, encodeNetascii)
+        else:
+            file = store.view(filename)
     except (storage.ErrorFileNotFound, storage.ErrorEmptyPath) as ex:
-        err = packERROR(
-            Errors['FILE_NOT_FOUND'],
+        err = getERROR(
+            ErrorCode.FILE_NOT_FOUND,
             str(ex))
-        sock.sendto(err, address)
+        sock.send(err)
         logClientError(address, ex)
         return
 
-    if mode == Modes['NETASCII']:
-        file = encodeNetascii(file)
+    try:
+        negotiateAndServe(address, sock, filename, file, options or {})
+    finally:
+        file.release()
 
-    data = None
-    sendDATA = False
-    readACK = False
-    dataBlock = 0
-    ackBlock = 0
-    fileSize = len(file)
-    sendCount = 0
-    # start and end are initially incremented by 512 to give file[0:512] slice
-    start = -512
-    end = 0
+def negotiateAndServe(address, sock, filename, file, options):
+    """Negotiates options and sends file, a memoryview, to the client with
+    serveFile(). Reports how the transfer ended to the client and the log.
+    """
+    accepted = negotiateOptions(options, len(file))
+    oack = None
+    if accepted:
+        log.debug("Client [%s:%s]: Sending OACK %s", *address, accepted)
+        oack = packOACK(accepted)
 
-    # Control is returned to handler() by explicit return
-    while True:
-        # Ready to build a new DATA packet
-        if ackBlock == dataBlock:
-            dataBlock += 1
-            start += 512
-            end += 512
-            if end > fileSize:
-                end = None
-
-            data = packDATA(file[start:end], dataBlock)
-            sendDATA = True
-            logging.debug(
-                "Client [{0}:{1}]: Creating datablock [{2}] on file {3}[{4}:{5}]"\
-                .format(*address, dataBlock, filename, start, end))
-
-        # Don't loop forever trying to send the same data packet
-        if sendCount >= MAX_PACKET_SEND_ATTEMPTS:
-            err = packERROR(
-                Errors['ACCESS_VIOLATION'],
-                "Maximum number of packet send attempts reached: [{}]"\
-                .format(sendCount))
-            sock.sendto(err, address)
-            logClientError(
-                address,
-                "Maximum number of packet send attempts reached: [{}]"\
-                .format(sendCount))
-            return
+    try:
+        serveFile(
+            sock,
+            file,
+            accepted.get('blksize', DATA_BLOCK_SIZE),
+            accepted.get('windowsize', 1),
+            oack)
+    except ErrorTransferAborted:
+        log.info(
+            "Client [%s:%s] aborted transfer of file [%s]",
+            *address, filename)
+    except ErrorTransferTimeout as ex:
+        sock.send(getERROR(ErrorCode.ACCESS_VIOLATION, str(ex)))
+        logClientError(address, ex)
+    except (ErrorIllegalOperation, ErrorUnknownOpcode, ErrorMalformedPacket) as ex:
+        sock.send(getERROR(ErrorCode.ILLEGAL_OPERATION, str(ex)))
+        logClientError(address, ex)
+    except OSError as ex:
+        # The socket is connected, so a client that went away shows up as
+        # ConnectionRefusedError (ICMP port unreachable)
+        log.info("Client [%s:%s]: Socket error: %s", *address, ex)
+    else:
+        log.debug(
+            "Client [%s:%s]: Finished sending file %s",
+            *address, filename)
+
+def serveFile(sock, file, blksize, windowsize, oack=None):
+    """Sends file as DATA packets on the connected socket sock, returning
+    once the client has acknowledged the last block.
+    Each DATA packet is 4 header bytes + blksize bytes long, except for the
+    last packet which is 4 header bytes + (0 <= data bytes < blksize).
+    When oack is given it is sent first and must be acknowledged with
+    ACK[0]. Up to windowsize DATA packets are sent before waiting for an
+    ACK; an ACK for any block in the window slides the window forward to
+    the block after it.
+    The loop only touches the socket: no logging and no error replies, so
+    it stays a tight loop (and a clean trace for a JIT such as PyPy).
+    Raises ErrorTransferAborted if the client sends an ERROR packet
+    Raises ErrorTransferTimeout after MAX_PACKET_SEND_ATTEMPTS unanswered sends
+    Raises ErrorIllegalOperation, ErrorUnknownOpcode or ErrorMalformedPacket
+    when the client sends anything other than an ACK
+    """
+    # Scratch space for DATA headers, or whole packets without sendmsg()
+    buf = bytearray(4 + blksize)
+    timer = RetransmitTimer()
+    # The socket stays non-blocking for the whole transfer; waits for the
+    # retransmit deadline happen in the selector
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    try:
+        # The last block is always shorter than blksize, so a file that is
+        # an exact multiple of blksize (including an empty file) ends with
+        # an empty block. Blocks are sliced from file as they are sent.
+        lastBlock = len(file) // blksize + 1
+        # Block numbers are tracked unwrapped; only the 16-bit wire value
+        # wraps.
+        ackBlock = 0
+        sentBlock = 0
+        sendCount = 0
+        sendWindow = True
+
+        while ackBlock < lastBlock:
+            # Don't loop forever trying to send the same window
+            if sendCount >= MAX_PACKET_SEND_ATTEMPTS:
+                raise ErrorTransferTimeout(
+                    "Maximum number of packet send attempts reached: [{}]"\
+                    .format(sendCount))
 
-        # We're sending a DATA packet
-        if sendDATA:
-            logging.debug(
-                "Client [{0}:{1}]: Sending datablock [{2}]"\
-                .format(*address, dataBlock))
-            sock.sendto(data, address)
-            sendDATA = False
-            readACK = True
-            sendCount += 1
-
-        # We're waiting for an ACK packet
-        if readACK:
-            logging.debug(
-                "Client [{0}:{1}]: Waiting for ACK for datablock [{2}]"\
-                .format(*address, dataBlock))
-            packet = sock.recv(1024)
-            if not packet:
-                # If we've timed out waiting for ACK, resend DATA
-                readACK = False
-                sendDATA = True
-                logging.debug(
-                    "Client [{0}:{1}]: Timed out waiting for ACK [{2}]. Resending data."\
-                    .format(*address, dataBlock))
-            else:
+            # (Re)send the OACK, or every DATA packet of the current window
+            if sendWindow:
+                if oack is not None:
+                    sock.send(oack)
+                else:
+                    sentBlock = min(ackBlock + windowsize, lastBlock)
+                    try:
+                        for block in range(ackBlock + 1, sentBlock + 1):
+                            sendDATA(
+                                sock,
+                                buf,
+                                file[(block - 1) * blksize:block * blksize],
+                                block & 0xFFFF)
+                    except BlockingIOError:
+                        # Send buffer is full; the rest of the window goes
+                        # out with the retransmit
+                        pass
+                sendWindow = False
+                sendCount += 1
+                sentAt = time.monotonic()
+                deadline = sentAt + timer.rto
+
+            # Wait only for what is left until the deadline, so ignored
+            # packets do not push the retransmit back
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                # If we've timed out waiting for ACK, resend the window
+                timer.backoff()
+                sendWindow = True
+                continue
+            try:
+                if windowsize == 1:
+                    packets = [sock.recv(1024)]
+                else:
+                    # Act on every queued ACK before sending, so a backlog
+                    # of ACKs slides the window once instead of once per ACK
+                    packets = recvQueued(sock, 1024)
+            except BlockingIOError:
+                # Woken without a packet to read; keep waiting
+                continue
+            rtt = time.monotonic() - sentAt
+
+            for packet in packets:
                 try:
                     opcode, block = unpackACK(packet)
-                    # Ignore all ACKs other than for current block
-                    if block == dataBlock:
-                        ackBlock = block
-                        readACK = False
+                except ErrorIllegalOperation:
+                    if unpackOpcode(packet) == _ERROR:
+                        raise ErrorTransferAborted(
+                            "Client sent an ERROR packet")
+                    raise
+
+                if oack is not None:
+                    # The OACK is acknowledged by ACK[0]
+                    if block == 0:
+                        if sendCount == 1:
+                            timer.sample(rtt)
+                        oack = None
+                        sendWindow = True
                         sendCount = 0
-                        logging.debug(
-                            "Client [{0}:{1}]: Received ACK for datablock [{2}]"\
-                            .format(*address, block))
-                    else:
-                        logging.debug(
-                            "Client [{0}:{1}]: Received ACK [{2}] for datablock [{3}]"\
-                            + " Still waiting for ACK [{2}]"\
-                            .format(*address, block, dataBlock))
-                except ErrorIllegalOperation as ex:
-                    err = packERROR(
-                        Errors['ILLEGAL_OPERATION'],
-                        str(ex))
-                    sock.sendto(err, address)
-                    logClientError(address, ex)
-                    return
-
-        # If we've acked the last block and no more data, we're done!
-        if ackBlock == dataBlock and end == None:
-            logging.debug(
-                "Client [{0}:{1}]: Finished sending file {2}"\
-                .format(*address, filename))
-            sock.close()
-            return
-
+                    continue
+
+                # Ignore ACKs outside of the window in flight
+                advance = (block - ackBlock) & 0xFFFF
+                if 0 < advance <= sentBlock - ackBlock:
+                    # Only windows sent once give an unambiguous RTT (Karn)
+                    if sendCount == 1:
+                        timer.sample(rtt)
+                    ackBlock += advance
+                    sendWindow = True
+                    sendCount = 0
+    finally:
+        selector.close()
+        sock.settimeout(timeout)
 
 def handleWRQ(address, sock, filename, mode):
     """Acknowleges WRQ request by sending ACK[0] packet to client.
     Reads DATA from sock until len(DATA) < 512.
     ACKs each DATA packet with DATA's block number.
     """
-    logging.info(
-        "Client [{0}:{1}] requested to put file [{2}] using transfer mode [{3}]"\
-        .format(*address, filename, mode))
+    log.info(
+        "Client [%s:%s] requested to put file [%s] using transfer mode [%s]",
+        *address, filename, mode)
     store = storage.Storage()
 
     if filename in store.store:
-        err = packERROR(
-            Errors['FILE_EXISTS'],
+        err = getERROR(
+            ErrorCode.FILE_EXISTS,
             "File '{}' already exists".format(filename))
-        sock.sendto(err, address)
+        sock.send(err)
         logClientError(
             address,
             "File '{}' already exists".format(filename))
@@ -378,76 +625,91 @@ def handleWRQ(address, sock, filename, mode):
     while True:
         # Build a new ACK packet to acknowledge received DATA packet
         if ackBlock != dataBlock:
-            logging.debug(
-                "Client [{0}:{1}]: Updating ACK [{2}] to ACK [{3}]"\
-                .format(*address, ackBlock, dataBlock))
+            log.debug(
+                "Client [%s:%s]: Updating ACK [%s] to ACK [%s]",
+                *address, ackBlock, dataBlock)
             ackBlock += 1
             ack = packACK(ackBlock)
             sendACK = True
 
         # Send ACK
         if sendACK:
+            # File transfer is terminated by acknowledging the last data
+            # packet, so the file is stored before the client can see it
+            if terminateTransfer:
+                log.debug(
+                    "Client [%s:%s]: Terminating transfer. Writing [%s] bytes of '%s'",
+                    *address, len(file), filename)
+
+                if mode == Modes['NETASCII']:
+                    file = decodeNetascii(file)
+
+                store.put(filename, file)
+
             try:
-                logging.debug(
-                    "Client [{0}:{1}]: Sending ACK [{2}]"\
-                    .format(*address, ackBlock))
-                sock.sendto(ack, address)
+                log.debug(
+                    "Client [%s:%s]: Sending ACK [%s]",
+                    *address, ackBlock)
+                sock.send(ack)
                 sendCount += 1
                 sendACK = False
                 readDATA = True
-            except ex:
-                logging.error("Socket send error during WRQ sendACK: {}".format(ex))
+            except OSError as ex:
+                log.error("Socket send error during WRQ sendACK: %s", ex)
                 return
 
-            # File transfer is terminated by acknowledging the last data packet
             if terminateTransfer:
-                logging.debug(
-                    "Client [{0}:{1}]: Terminating transfer. Writing [{2}] bytes of '{3}'"\
-                    .format(*address, len(file), filename))
-
                 sock.close()
-                if mode == Modes['NETASCII']:
-                    file = decodeNetascii(file)
-
-                store.put(filename, file)
                 return
 
         # Don't try and send ACK packets for ever...
         if sendCount >= MAX_PACKET_SEND_ATTEMPTS:
-            err = packERROR(
-                Errors['ACCESS_VIOLATION'],
+            err = getERROR(
+                ErrorCode.ACCESS_VIOLATION,
                 "Maximum number of packet send attempts reached: [{}]"\
                 .format(sendCount))
             try:
-                sock.sendto(err, address)
+                sock.send(err)
                 logClientError(
                     address,
                     "Maximum number of packet send attempts reached: [{}]"\
                     .format(sendCount))
             except Exception as ex:
-                logging.error(
-                    "Socket send error during WRQ sendCount: {}"\
-                    .format(ex))
+                log.error(
+                    "Socket send error during WRQ sendCount: %s",
+                    ex)
             return
 
         # Read DATA
         if readDATA:
-            packet = sock.recv(1024)
+            try:
+                packet = sock.recv(1024)
+            except socket.timeout:
+                # If we've timed out waiting for DATA, resend the ACK
+                log.debug(
+                    "Client [%s:%s]: Timed out waiting for DATA [%s]. Resending ACK.",
+                    *address, dataBlock + 1)
+                readDATA = False
+                sendACK = True
+                continue
+            except OSError as ex:
+                log.info("Client [%s:%s]: Socket error: %s", *address, ex)
+                return
             if packet:
                 try:
                     opcode, block, chunk = unpackDATA(packet)
                 except (ErrorMalformedPacket, ErrorIllegalOperation) as ex:
-                    err = packERROR(
-                        Errors['ILLEGAL_OPERATION'],
+                    err = getERROR(
+                        ErrorCode.ILLEGAL_OPERATION,
                         str(ex))
-                    sock.sendto(err, address)
+                    sock.send(err)
                     logClientError(address, ex)
                     return
 
                 if block == dataBlock + 1:
-                    logging.debug(
-                        "Client [{0}:{1}]: Reading DATA [{2}]"\
-                        .format(*address, block))
+                    log.debug(
+                        "Client [%s:%s]: Reading DATA [%s]",
+                        *address, block)
                     sendCount = 0
                     dataBlock = block
                     # Chunk could be zero-length if last packet
@@ -457,46 +719,80 @@ def handleWRQ(address, sock, filename, mode):
                     if len(chunk) < DATA_BLOCK_SIZE:
                         terminateTransfer = True
                 else:
-                    logging.debug(
-                        "Client [{0}:{1}]: Received duplicate DATA [{2}] Still waiting for DATA [{3}]"\
-                        .format(*address, block, dataBlock + 1))
+                    log.debug(
+                        "Client [%s:%s]: Received duplicate DATA [%s] Still waiting for DATA [%s]",
+                        *address, block, dataBlock + 1)
 
 class Handler(socketserver.BaseRequestHandler):
     """Main TFTP socketserver handler class"""
     def handle(self):
         packet, sock = self.request
-        logging.debug("Receiving packet from client: {}".format(packet))
+        log.debug("Receiving packet from client: %s", packet)
 
         try:
-            opcode, filename, mode = unpackRWRQ(packet)
+            opcode, filename, mode, options = unpackRWRQ(packet)
         except ErrorUnknownMode as ex:
-            err = packERROR(
-                Errors['ACCESS_VIOLATION'],
+            err = getERROR(
+                ErrorCode.ACCESS_VIOLATION,
                 str(ex))
             sock.sendto(err, self.client_address)
             logClientError(self.client_address, err)
             return
         except storage.ErrorEmptyPath as ex:
-            err = packERROR(
-                Errors['FILE_NOT_FOUND'],
+            err = getERROR(
+                ErrorCode.FILE_NOT_FOUND,
                 str(ex))
             sock.sendto(err, self.client_address)
             logClientError(self.client_address, err)
             return
-        except (ErrorIllegalOperation, ErrorUnknownOpcode) as ex:
-            err = packERROR(
-                Errors['ILLEGAL_OPERATION'],
+        except (ErrorIllegalOperation, ErrorUnknownOpcode, ErrorMalformedPacket) as ex:
+            err = getERROR(
+                ErrorCode.ILLEGAL_OPERATION,
                 str(ex))
             sock.sendto(err, self.client_address)
             logClientError(self.client_address, err)
             return
 
-        # Create a new UDP socket for remainder of session
+        # Create a new UDP socket for remainder of session, connected to the
+        # client so the kernel filters out packets from any other TID
         stid = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        host = self.server.server_address[0]
-        stid.bind((host, 0))
+        try:
+            setSocketBuffers(stid)
+            setBusyPoll(stid)
+            host = self.server.server_address[0]
+            stid.bind((host, 0))
+            stid.connect(self.client_address)
+            stid.settimeout(SOCKET_TIMEOUT)
+
+            if opcode == Opcode.RRQ:
+                handleRRQ(self.client_address, stid, filename, mode, options)
+            else:
+                handleWRQ(self.client_address, stid, filename, mode)
+        finally:
+            stid.close()
 
-        if opcode == Opcodes['RRQ']:
-            handleRRQ(self.client_address, stid, filename, mode)
-        else:
-            handleWRQ(self.client_address, stid, filename, mode)
+class PoolMixIn(socketserver.ThreadingMixIn):
+    """Mix-in class to handle each request in a bounded pool of reused
+    threads instead of starting a new thread per request.
+    """
+    max_workers = MAX_WORKERS
+    executor = None
+
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='tftp-worker')
+        self.executor.submit(
+            self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=self.block_on_close)
+
+class Server(PoolMixIn, socketserver.UDPServer):
+    """Thread-pooled TFTP UDP server with enlarged socket buffers"""
+    def server_bind(self):
+        super().server_bind()
+        setSocketBuffers(self.socket)
@@ -1,5 +1,9 @@
+import collections
 import threading
 
+# Number of encoded file copies kept by Storage.viewEncoded()
+CACHE_SIZE = 32
+
 class ErrorEmptyPath(Exception):
     pass
 
@@ -22,6 +26,7 @@ class Storage(object):
         def __init__(self):
             self.store = {}
             self.mutex = threading.Lock()
+            self.cache = collections.OrderedDict()
 
         def get(self, path=None):
             with self.mutex:
@@ -32,6 +37,32 @@ class Storage(object):
                 else:
                     raise ErrorFileNotFound("No such file '{}'".format(path))
 
+        def view(self, path=None):
+            """Returns a read-only memoryview sharing the stored file's
+            memory, so callers can slice it without copying.
+            """
+            return memoryview(self.get(path)).toreadonly()
+
+        def viewEncoded(self, path, encode):
+            """Returns a read-only memoryview of encode(file) for the file at
+            path. The CACHE_SIZE most recently used encodings are kept, so
+            repeated reads of a file are only encoded once. Stored files
+            never change, so a cached encoding cannot go stale.
+            """
+            key = (path, encode)
+            with self.mutex:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    return memoryview(self.cache[key]).toreadonly()
+
+            # Encode outside the lock so other transfers are not held up
+            encoded = bytes(encode(self.get(path)))
+            with self.mutex:
+                self.cache[key] = encoded
+                if len(self.cache) > CACHE_SIZE:
+                    self.cache.popitem(last=False)
+            return memoryview(encoded).toreadonly()
+
         def put(self, path=None, file=None):
             with self.mutex:
                 if not path:
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import socket
+import threading
+import time
+import unittest
+import uuid
+
+import aioserver
+import server
+import storage
+
+logging.basicConfig(
+    format='%(asctime)s -- %(levelname)s: %(message)s',
+    level=logging.DEBUG)
+
+class TestAioServer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.start()
+        self.transport, self.protocol = asyncio.run_coroutine_threadsafe(
+            aioserver.listen('localhost', 0), self.loop).result()
+        self.send_to = self.transport.get_extra_info('sockname')
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(5)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def request(self, opcode, fields):
+        b = bytearray()
+        b.extend(server.Opcode[opcode].to_bytes(2, 'big'))
+        for field in fields:
+            b.extend(bytes(field, 'utf-8'))
+            b.append(0)
+        self.client.sendto(b, self.send_to)
+
+    def test_fileNotFound(self):
+        self.request('RRQ', ('no_such_aio_file', 'octet'))
+        answer, self.send_to = self.client.recvfrom(1024)
+        self.assertEqual(
+            server.unpackOpcode(answer),
+            server.Opcode.ERROR)
+        self.assertEqual(
+            int.from_bytes(answer[2:4], 'big'),
+            server.ErrorCode.FILE_NOT_FOUND)
+
+    def test_readWindowed(self):
+        d = str(uuid.uuid1())
+        file = bytearray(bytes((d * 40)[:1000], 'utf-8'))
+        fileName = 'aio_windowed_file'
+        storage.Storage().put(fileName, file)
+
+        self.request('RRQ', (fileName, 'octet', 'blksize', '256',
+            'windowsize', '8'))
+        oack, self.send_to = self.client.recvfrom(1024)
+        self.assertEqual(
+            oack,
+            server.packOACK({'blksize': 256, 'windowsize': 8}))
+        self.client.sendto(server.packACK(0), self.send_to)
+
+        data = bytearray()
+        for i in range(1, 5):
+            packet, self.send_to = self.client.recvfrom(1024)
+            op, block, chunk = server.unpackDATA(packet)
+            self.assertEqual(block, i)
+            data.extend(chunk)
+        self.client.sendto(server.packACK(4), self.send_to)
+        self.assertEqual(data, file)
+
+    def test_endpointFailure(self):
+        self.client.bind(('localhost', 0))
+        packet = bytearray(server.Opcode.RRQ.to_bytes(2, 'big'))
+        packet.extend(b'no_such_aio_file\x00octet\x00')
+
+        async def failedRequest():
+            # 192.0.2.0/24 (TEST-NET-1) is not a local address, so binding
+            # the transfer endpoint fails
+            self.protocol.host = '192.0.2.1'
+            self.protocol.datagram_received(
+                bytes(packet), self.client.getsockname())
+            self.protocol.host = 'localhost'
+        asyncio.run_coroutine_threadsafe(failedRequest(), self.loop).result()
+
+        # The failed transfer must not swallow the client's later requests
+        self.client.settimeout(0.1)
+        for _ in range(20):
+            self.client.sendto(packet, self.send_to)
+            try:
+                answer, address = self.client.recvfrom(1024)
+                break
+            except socket.timeout:
+                pass
+        else:
+            self.fail("Request after a failed transfer was not answered")
+        self.assertEqual(
+            server.unpackOpcode(answer),
+            server.Opcode.ERROR)
+
+    def test_retransmit(self):
+        fileName = 'aio_retransmit_file'
+        storage.Storage().put(fileName, bytearray(b'cabbage'))
+        self.request('RRQ', (fileName, 'octet'))
+
+        first, self.send_to = self.client.recvfrom(1024)
+        # Withholding the ACK makes the server resend the same block
+        second, self.send_to = self.client.recvfrom(1024)
+        self.assertEqual(first, second)
+        self.client.sendto(server.packACK(1), self.send_to)
+
+    def test_clientGone(self):
+        fileName = 'aio_gone_file'
+        storage.Storage().put(fileName, bytearray(2048))
+        self.request('RRQ', (fileName, 'octet'))
+        self.client.recvfrom(1024)
+
+        # Closing the client makes the retransmit draw an ICMP port
+        # unreachable, which ends the transfer long before it gives up
+        self.client.close()
+        deadline = time.monotonic() + 3 * server.MAX_RTO
+        while self.protocol.transfers and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.protocol.transfers, {})
+
+    def test_writeThenRead(self):
+        fileName = 'aio_writing_file'
+        d = str(uuid.uuid1())
+        file = bytearray(bytes((d * 40)[:1024], 'utf-8'))
+
+        self.request('WRQ', (fileName, 'octet'))
+        answer, self.send_to = self.client.recvfrom(1024)
+        self.assertEqual(server.unpackACK(answer)[1], 0)
+
+        for block in range(1, 4):
+            start = (block - 1) * 512
+            self.client.sendto(
+                server.packDATA(file[start:start + 512], block),
+                self.send_to)
+            answer, self.send_to = self.client.recvfrom(1024)
+            self.assertEqual(server.unpackACK(answer)[1], block)
+
+        self.assertEqual(storage.Storage().get(fileName), file)
+
+if __name__ == '__main__':
+    unittest.main()
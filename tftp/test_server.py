@@ -2,7 +2,6 @@ import logging
 import unittest
 import uuid
 import socket
-import socketserver
 import threading
 
 import server
@@ -22,7 +21,7 @@ class TestHandlerHelpers(unittest.TestCase):
         b.extend(bytes("netascii", 'utf-8'))
         b.append(0)
 
-        for i in range(1, 6):
+        for i in range(1, 7):
             b[1] = i
             t = server.unpackOpcode(b)
             self.assertEqual(t, i)
@@ -41,13 +40,20 @@ class TestHandlerHelpers(unittest.TestCase):
             server.unpackOpcode,
             b)
 
-        # Test Opcode 6
-        b[1] = 6
+        # Test Opcode 7
+        b[1] = 7
         self.assertRaises(
             server.ErrorUnknownOpcode,
             server.unpackOpcode,
             b)
 
+    def test_unknownOpcode_shortPacket(self):
+        for b in (b'', b'\x00'):
+            self.assertRaises(
+                server.ErrorUnknownOpcode,
+                server.unpackOpcode,
+                b)
+
     def test_UnknownErrorCodes(self):
         self.assertRaises(
             server.ErrorUnknownErrorCode,
@@ -65,7 +71,7 @@ class TestHandlerHelpers(unittest.TestCase):
 
     def test_packError(self):
         b = bytearray()
-        b.extend(server.Opcodes['ERROR'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.ERROR.to_bytes(2, 'big'))
         b.extend(int(0).to_bytes(2, 'big'))
         b.extend(bytes('Cabbage Icecream!', 'utf-8'))
         b.append(0)
@@ -75,12 +81,28 @@ class TestHandlerHelpers(unittest.TestCase):
             e = server.packERROR(i, 'Cabbage Icecream!')
             self.assertEqual(b, e)
 
+    def test_getERROR(self):
+        e = server.getERROR(server.ErrorCode.FILE_NOT_FOUND, 'Cabbage Icecream!')
+        self.assertEqual(
+            e,
+            server.packERROR(server.ErrorCode.FILE_NOT_FOUND, 'Cabbage Icecream!'))
+        self.assertIsInstance(e, bytes)
+        self.assertIs(
+            e,
+            server.getERROR(server.ErrorCode.FILE_NOT_FOUND, 'Cabbage Icecream!'))
+
+        self.assertRaises(
+            server.ErrorUnknownErrorCode,
+            server.getERROR,
+            8,
+            "Cabbage Icecream!")
+
     def test_packDATA_withData(self):
         blockNum = 55
         d = str(uuid.uuid1())
         data = bytes(d, 'utf-8')
         b = bytearray()
-        b.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         b.extend(blockNum.to_bytes(2, 'big'))
         b.extend(data)
 
@@ -91,31 +113,83 @@ class TestHandlerHelpers(unittest.TestCase):
         blockNum = 55
         data = bytearray()
         b = bytearray()
-        b.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         b.extend(blockNum.to_bytes(2, 'big'))
         b.extend(data)
 
         dp = server.packDATA(data, blockNum)
         self.assertEqual(dp, b)
 
+    def test_packDATAInto(self):
+        blockNum = 55
+        data = bytes(str(uuid.uuid1()), 'utf-8')
+        buf = bytearray(4 + 512)
+
+        dp = server.packDATAInto(buf, data, blockNum)
+        self.assertEqual(dp, server.packDATA(data, blockNum))
+
+        # A shorter packet reuses the same buffer
+        dp = server.packDATAInto(buf, data[:3], blockNum + 1)
+        self.assertEqual(dp, server.packDATA(data[:3], blockNum + 1))
+
+    def test_sendDATA(self):
+        blockNum = 55
+        data = memoryview(bytes(str(uuid.uuid1()), 'utf-8'))
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('localhost', 0))
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        sender.connect(receiver.getsockname())
+        server.sendDATA(sender, bytearray(4 + 512), data, blockNum)
+        packet = receiver.recv(1024)
+        sender.close()
+        receiver.close()
+        self.assertEqual(packet, server.packDATA(data, blockNum))
+
+    def test_recvQueued(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('localhost', 0))
+        receiver.setblocking(False)
+        self.assertRaises(
+            BlockingIOError,
+            server.recvQueued,
+            receiver,
+            1024)
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for blockNum in range(1, 4):
+            sender.sendto(server.packACK(blockNum), receiver.getsockname())
+
+        packets = []
+        while len(packets) < 3:
+            try:
+                packets.extend(server.recvQueued(receiver, 1024))
+            except BlockingIOError:
+                pass
+        sender.close()
+        receiver.close()
+        self.assertEqual(
+            packets,
+            [server.packACK(blockNum) for blockNum in range(1, 4)])
+
     def test_unpackDATA_withData(self):
         blockNum = 55
         d = str(uuid.uuid1())
         data = bytearray()
         data.extend(bytes(d, 'utf-8'))
         b = bytearray()
-        b.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         b.extend(blockNum.to_bytes(2, 'big'))
         b.extend(data)
 
         tOp, tBlock, tData = server.unpackDATA(b)
-        self.assertEqual(tOp, server.Opcodes['DATA'])
+        self.assertEqual(tOp, server.Opcode.DATA)
         self.assertEqual(tBlock, blockNum)
         self.assertEqual(tData, data)
 
     def test_unpackDATA_malformedPacket(self):
         b = bytearray()
-        b.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         b.append(55)
 
         self.assertRaises(
@@ -127,7 +201,7 @@ class TestHandlerHelpers(unittest.TestCase):
         blockNum = 55
         data = "hereissomedata"
         b = bytearray()
-        b.extend(server.Opcodes['WRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.WRQ.to_bytes(2, 'big'))
         b.extend(blockNum.to_bytes(2, 'big'))
         b.extend(bytes(data, 'utf-8'))
 
@@ -140,7 +214,7 @@ class TestHandlerHelpers(unittest.TestCase):
         filename = 'myfile'
         mode = 'netascii'
         b = bytearray()
-        b.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         b.extend(bytes(filename, 'utf-8'))
         b.append(0)
         b.extend(bytes(mode, 'utf-8'))
@@ -155,7 +229,7 @@ class TestHandlerHelpers(unittest.TestCase):
         filename = 'myfile'
         mode = 'netascii'
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(filename, 'utf-8'))
         b.extend(bytes(mode, 'utf-8'))
 
@@ -168,7 +242,7 @@ class TestHandlerHelpers(unittest.TestCase):
         filename = 'myfile'
         mode = 'netascii'
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(filename, 'utf-8'))
         b.append(0)
         b.extend(bytes(mode, 'utf-8'))
@@ -182,7 +256,7 @@ class TestHandlerHelpers(unittest.TestCase):
         filename = ''
         mode = 'netascii'
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(filename, 'utf-8'))
         b.append(0)
         b.extend(bytes(mode, 'utf-8'))
@@ -197,7 +271,7 @@ class TestHandlerHelpers(unittest.TestCase):
         filename = 'myfile'
         mode = 'say_friend_and_open'
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(filename, 'utf-8'))
         b.append(0)
         b.extend(bytes(mode, 'utf-8'))
@@ -212,20 +286,83 @@ class TestHandlerHelpers(unittest.TestCase):
         filename = 'myfile'
         mode = 'octet'
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(filename, 'utf-8'))
         b.append(0)
         b.extend(bytes(mode, 'utf-8'))
         b.append(0)
 
-        tOp, tFile, tMode = server.unpackRWRQ(b)
-        self.assertEqual(tOp, server.Opcodes['RRQ'])
+        tOp, tFile, tMode, tOptions = server.unpackRWRQ(b)
+        self.assertEqual(tOp, server.Opcode.RRQ)
         self.assertEqual(tFile, filename)
         self.assertEqual(tMode.lower(), mode)
+        self.assertEqual(tOptions, {})
+
+    def test_unpackRWRQ_withOptions(self):
+        b = bytearray()
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
+        for field in ('myfile', 'octet', 'BLKSIZE', '1468', 'windowsize', '16'):
+            b.extend(bytes(field, 'utf-8'))
+            b.append(0)
+
+        tOp, tFile, tMode, tOptions = server.unpackRWRQ(b)
+        self.assertEqual(tFile, 'myfile')
+        self.assertEqual(tOptions, {'blksize': '1468', 'windowsize': '16'})
+
+    def test_unpackRWRQ_missingOptionValueTermination(self):
+        b = bytearray()
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
+        for field in ('myfile', 'octet', 'blksize'):
+            b.extend(bytes(field, 'utf-8'))
+            b.append(0)
+        b.extend(bytes('1468', 'utf-8'))
+
+        self.assertRaises(
+            server.ErrorMalformedPacket,
+            server.unpackRWRQ,
+            b)
+
+    def test_unpackRWRQ_invalidUTF8(self):
+        for fields in (
+                (b'\xff\xfe', b'octet'),
+                (b'myfile', b'\xff\xfe'),
+                (b'myfile', b'octet', b'blksize', b'\xff\xfe')):
+            b = bytearray()
+            b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
+            for field in fields:
+                b.extend(field)
+                b.append(0)
+
+            self.assertRaises(
+                server.ErrorMalformedPacket,
+                server.unpackRWRQ,
+                b)
+
+    def test_negotiateOptions(self):
+        options = {
+            'blksize': '100000',
+            'windowsize': '0',
+            'tsize': '0',
+            'timeout': '5'}
+        accepted = server.negotiateOptions(options, 1234)
+        self.assertEqual(
+            accepted,
+            {'blksize': server.MAX_BLKSIZE, 'tsize': 1234})
+
+        accepted = server.negotiateOptions({'blksize': 'cabbage'}, 0)
+        self.assertEqual(accepted, {})
+
+    def test_packOACK(self):
+        b = bytearray()
+        b.extend(server.Opcode.OACK.to_bytes(2, 'big'))
+        b.extend(b'blksize\x001468\x00windowsize\x004\x00')
+
+        tP = server.packOACK({'blksize': 1468, 'windowsize': 4})
+        self.assertEqual(tP, b)
 
     def test_unpackACK_illegalOperation(self):
         b = bytearray()
-        b.extend(server.Opcodes['ERROR'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.ERROR.to_bytes(2, 'big'))
         b.extend(int(55).to_bytes(2, 'big'))
 
         self.assertRaises(
@@ -233,25 +370,81 @@ class TestHandlerHelpers(unittest.TestCase):
             server.unpackACK,
             b)
 
+    def test_unpackACK_malformedPacket(self):
+        b = bytearray()
+        b.extend(server.Opcode.ACK.to_bytes(2, 'big'))
+        b.append(55)
+
+        self.assertRaises(
+            server.ErrorMalformedPacket,
+            server.unpackACK,
+            b)
+
     def test_unpackACK(self):
         blockNum = 55
         b = bytearray()
-        b.extend(server.Opcodes['ACK'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.ACK.to_bytes(2, 'big'))
         b.extend(blockNum.to_bytes(2, 'big'))
 
         tOp, tBlock = server.unpackACK(b)
-        self.assertEqual(tOp, server.Opcodes['ACK'])
+        self.assertEqual(tOp, server.Opcode.ACK)
         self.assertEqual(tBlock, blockNum)
 
     def test_packACK(self):
         blockNum = 55
         b = bytearray()
-        b.extend(server.Opcodes['ACK'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.ACK.to_bytes(2, 'big'))
         b.extend(blockNum.to_bytes(2, 'big'))
 
         tP = server.packACK(blockNum)
         self.assertEqual(tP, b)
 
+    @unittest.skipIf(server._SO_BUSY_POLL is None, 'requires SO_BUSY_POLL')
+    def test_setBusyPoll(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        busyPoll = server.BUSY_POLL_USEC
+        server.BUSY_POLL_USEC = 50
+        try:
+            # Unprivileged processes may be refused; that must not raise
+            server.setBusyPoll(sock)
+            value = sock.getsockopt(socket.SOL_SOCKET, server._SO_BUSY_POLL)
+        finally:
+            server.BUSY_POLL_USEC = busyPoll
+            sock.close()
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.setsockopt(socket.SOL_SOCKET, server._SO_BUSY_POLL, 50)
+            accepted = True
+        except OSError:
+            accepted = False
+        finally:
+            probe.close()
+        self.assertEqual(value, 50 if accepted else 0)
+
+    def test_retransmitTimer(self):
+        timer = server.RetransmitTimer()
+        self.assertEqual(timer.rto, server.MAX_RTO)
+
+        # Fast, steady round trips settle on the floor
+        for _ in range(20):
+            timer.sample(0.001)
+        self.assertEqual(timer.rto, server.MIN_RTO)
+
+        # Slow round trips are capped
+        timer.sample(5.0)
+        self.assertEqual(timer.rto, server.MAX_RTO)
+
+    def test_retransmitTimer_backoff(self):
+        timer = server.RetransmitTimer()
+        timer.sample(0.05)
+        rto = timer.rto
+        timer.backoff()
+        self.assertEqual(timer.rto, min(rto * 2, server.MAX_RTO))
+        for _ in range(10):
+            timer.backoff()
+        self.assertEqual(timer.rto, server.MAX_RTO)
+
     def test_encodeNetascii(self):
         # UNIX newline \n
         # Macintosh newline \r
@@ -274,9 +467,95 @@ class TestHandlerHelpers(unittest.TestCase):
 
 
 
+class TestTransfer(unittest.TestCase):
+    """Testing the read loop over a connected pair of sockets"""
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('localhost', 0))
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('localhost', 0))
+        self.client.settimeout(5)
+        self.sock.connect(self.client.getsockname())
+        self.client.connect(self.sock.getsockname())
+        self.errors = []
+
+    def tearDown(self):
+        self.sock.close()
+        self.client.close()
+
+    def start(self, function, *args):
+        """Runs function(*args) in a new thread, collecting anything it
+        raises in self.errors, and returns the thread.
+        """
+        def run():
+            try:
+                function(*args)
+            except Exception as ex:
+                self.errors.append(ex)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_serveFile(self):
+        file = memoryview(bytes(range(10)))
+        thread = self.start(server.serveFile, self.sock, file, 4, 2)
+
+        data = bytearray()
+        for block in (1, 2, 3):
+            op, blockNum, chunk = server.unpackDATA(self.client.recv(1024))
+            self.assertEqual(blockNum, block)
+            data.extend(chunk)
+            if block != 1:
+                self.client.send(server.packACK(block))
+        thread.join()
+        self.assertEqual(self.errors, [])
+        self.assertEqual(data, file)
+
+    def test_serveFile_exactMultiple(self):
+        # Files of an exact multiple of blksize end with an empty block
+        file = memoryview(bytes(range(8)))
+        thread = self.start(server.serveFile, self.sock, file, 4, 4)
+
+        chunks = []
+        for block in (1, 2, 3):
+            op, blockNum, chunk = server.unpackDATA(self.client.recv(1024))
+            self.assertEqual(blockNum, block)
+            chunks.append(bytes(chunk))
+        self.client.send(server.packACK(3))
+        thread.join()
+        self.assertEqual(self.errors, [])
+        self.assertEqual(chunks, [file[0:4], file[4:8], b''])
+
+    def test_negotiateAndServe_clientGone(self):
+        thread = self.start(
+            server.negotiateAndServe,
+            self.client.getsockname(),
+            self.sock,
+            'gone_file',
+            memoryview(bytes(2048)),
+            {})
+
+        # Closing the client makes the retransmit draw an ICMP port
+        # unreachable, which ends the transfer without raising
+        self.client.recv(1024)
+        self.client.close()
+        thread.join()
+        self.assertEqual(self.errors, [])
+
+    def test_serveFile_aborted(self):
+        thread = self.start(
+            server.serveFile, self.sock, memoryview(b'cabbage'), 512, 1)
+
+        self.client.recv(1024)
+        self.client.send(
+            server.packERROR(server.ErrorCode.NOT_DEFINED, 'Cancelled'))
+        thread.join()
+        self.assertEqual(len(self.errors), 1)
+        self.assertIsInstance(self.errors[0], server.ErrorTransferAborted)
+
 class TestServer(unittest.TestCase):
     def setUp(self):
-        self.server = socketserver.ThreadingUDPServer(('localhost',0), server.Handler)
+        self.server = server.Server(('localhost',0), server.Handler)
         self.server_thread = threading.Thread(target=self.server.serve_forever)
         self.send_to = self.server.server_address
         self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -287,6 +566,16 @@ class TestServer(unittest.TestCase):
         self.server.shutdown()
         self.server.server_close()
 
+    def test_socketBuffers(self):
+        # Linux doubles the requested size and clamps it to rmem/wmem_max,
+        # so only check the buffers grew past the stock defaults.
+        default = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            self.assertGreater(
+                self.server.socket.getsockopt(socket.SOL_SOCKET, opt),
+                default.getsockopt(socket.SOL_SOCKET, opt))
+        default.close()
+
     def test_handleRRQ(self):
         store = storage.Storage()
         d = str(uuid.uuid1())
@@ -299,7 +588,7 @@ class TestServer(unittest.TestCase):
 
         # Build and send RRQ packet
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(fileName, 'utf-8'))
         b.append(0)
         b.extend(bytes('netascii', 'utf-8'))
@@ -333,6 +622,69 @@ class TestServer(unittest.TestCase):
         self.assertEqual(answer2[4:], file[512:1024])
         self.assertEqual(answer3[4:], file[1024:])
 
+    def test_handleRRQ_windowed(self):
+        store = storage.Storage()
+        d = str(uuid.uuid1())
+        # Five 100 byte blocks and an empty terminating block
+        file = bytearray(bytes((d * 20)[:500], 'utf-8'))
+        fileName = 'my_windowed_file'
+        store.put(fileName, file)
+
+        b = bytearray()
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
+        for field in ('my_windowed_file', 'octet', 'blksize', '100',
+                'windowsize', '4', 'tsize', '0'):
+            b.extend(bytes(field, 'utf-8'))
+            b.append(0)
+        self.client.sendto(b, self.send_to)
+
+        oack, self.send_to = self.client.recvfrom(1024)
+        self.assertEqual(
+            oack,
+            server.packOACK({'blksize': 100, 'windowsize': 4, 'tsize': 500}))
+        self.client.sendto(server.packACK(0), self.send_to)
+
+        # The first window holds blocks 1 to 4
+        received = []
+        for _ in range(4):
+            packet, self.send_to = self.client.recvfrom(1024)
+            received.append(server.unpackDATA(packet))
+        self.assertEqual([r[1] for r in received], [1, 2, 3, 4])
+
+        # Acknowledging block 2 slides the window to blocks 3 to 6
+        self.client.sendto(server.packACK(2), self.send_to)
+        for _ in range(4):
+            packet, self.send_to = self.client.recvfrom(1024)
+            received.append(server.unpackDATA(packet))
+        self.assertEqual([r[1] for r in received[4:]], [3, 4, 5, 6])
+        self.client.sendto(server.packACK(6), self.send_to)
+
+        data = bytearray()
+        for op, block, chunk in received[:2] + received[4:]:
+            data.extend(chunk)
+        self.assertEqual(data, file)
+        self.assertEqual(len(received[-1][2]), 0)
+
+    def test_handleRRQ_retransmit(self):
+        store = storage.Storage()
+        fileName = 'my_retransmit_file'
+        store.put(fileName, bytearray(b'cabbage'))
+
+        b = bytearray()
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
+        b.extend(bytes(fileName, 'utf-8'))
+        b.append(0)
+        b.extend(bytes('octet', 'utf-8'))
+        b.append(0)
+        self.client.settimeout(5)
+        self.client.sendto(b, self.send_to)
+
+        first, self.send_to = self.client.recvfrom(1024)
+        # Withholding the ACK makes the server resend the same block
+        second, self.send_to = self.client.recvfrom(1024)
+        self.assertEqual(first, second)
+        self.client.sendto(server.packACK(1), self.send_to)
+
     def test_handleWRQ(self):
         store = storage.Storage()
         fileName = 'writing_file'
@@ -353,7 +705,7 @@ class TestServer(unittest.TestCase):
 
         # Build and send RRQ packet
         b = bytearray()
-        b.extend(server.Opcodes['WRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.WRQ.to_bytes(2, 'big'))
         b.extend(bytes(fileName, 'utf-8'))
         b.append(0)
         b.extend(bytes('netascii', 'utf-8'))
@@ -366,7 +718,7 @@ class TestServer(unittest.TestCase):
         # Build DATA packet for data block #1
         dataBlock = 1
         a = bytearray()
-        a.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        a.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         a.extend(dataBlock.to_bytes(2, 'big'))
         a.extend(file[0:512])
         self.client.sendto(a, self.send_to)
@@ -377,7 +729,7 @@ class TestServer(unittest.TestCase):
         # Build and send DATA for data block #2
         dataBlock += 1
         a2 = bytearray()
-        a2.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        a2.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         a2.extend(dataBlock.to_bytes(2, 'big'))
         a2.extend(file[512:1024])
         self.client.sendto(a2, self.send_to)
@@ -388,7 +740,7 @@ class TestServer(unittest.TestCase):
         # Build and send DATA for data block #3
         dataBlock += 1
         a3 = bytearray()
-        a3.extend(server.Opcodes['DATA'].to_bytes(2, 'big'))
+        a3.extend(server.Opcode.DATA.to_bytes(2, 'big'))
         a3.extend(dataBlock.to_bytes(2, 'big'))
         a3.extend(file[1024:])
         self.client.sendto(a3, self.send_to)
@@ -404,7 +756,7 @@ class TestServer(unittest.TestCase):
         self.send_to = self.server.server_address
         self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         b = bytearray()
-        b.extend(server.Opcodes['RRQ'].to_bytes(2, 'big'))
+        b.extend(server.Opcode.RRQ.to_bytes(2, 'big'))
         b.extend(bytes(fileName, 'utf-8'))
         b.append(0)
         b.extend(bytes('octet', 'utf-8'))
@@ -414,7 +766,7 @@ class TestServer(unittest.TestCase):
         d1, self.send_to = self.client.recvfrom(1024)
 
         ak = bytearray()
-        ak.extend(server.Opcodes['ACK'].to_bytes(2, 'big'))
+        ak.extend(server.Opcode.ACK.to_bytes(2, 'big'))
         ak.extend(int(1).to_bytes(2, 'big'))
 
         self.client.sendto(ak, self.send_to)
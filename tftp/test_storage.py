@@ -43,6 +43,48 @@ class TestStorage(unittest.TestCase):
         t = a.get(fileName)
         self.assertEqual(file, t)
 
+    def test_viewFile(self):
+        file = bytearray(str(uuid.uuid1()), 'utf-8')
+        fileName = uuid.uuid1()
+        a = storage.Storage()
+        a.put(fileName, file)
+        with a.view(fileName) as t:
+            self.assertEqual(t, file)
+            self.assertTrue(t.readonly)
+
+    def test_viewFileNotFound(self):
+        a = storage.Storage()
+        self.assertRaises(
+            storage.ErrorFileNotFound,
+            a.view,
+            "not_a_file")
+
+    def test_viewEncoded(self):
+        calls = []
+        def encode(data):
+            calls.append(data)
+            return data.upper()
+
+        fileName = uuid.uuid1()
+        a = storage.Storage()
+        a.put(fileName, bytearray(b'cabbage'))
+        for _ in range(2):
+            with a.viewEncoded(fileName, encode) as t:
+                self.assertEqual(t, b'CABBAGE')
+                self.assertTrue(t.readonly)
+        self.assertEqual(len(calls), 1)
+
+    def test_viewEncodedEviction(self):
+        encode = lambda data: data
+        a = storage.Storage()
+        fileNames = [uuid.uuid1() for _ in range(storage.CACHE_SIZE + 1)]
+        for fileName in fileNames:
+            a.put(fileName, bytearray(b'cabbage'))
+            a.viewEncoded(fileName, encode)
+        self.assertNotIn((fileNames[0], encode), a.cache)
+        self.assertIn((fileNames[-1], encode), a.cache)
+        self.assertLessEqual(len(a.cache), storage.CACHE_SIZE)
+
     def test_putFileExists(self):
         file = uuid.uuid1()
         fileName = uuid.uuid1()